@@ -7,42 +7,164 @@ It is currently not intended to be imported and instead should be executed
 directly as a python script.
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum, auto
-import glob
 import hashlib
+import itertools
 import json
+import mmap
 import os
 import re
-import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 # External URL processing library
 # http://docs.python-requests.org/en/master/user/quickstart/
 import requests
+from requests.adapters import HTTPAdapter
+
+# Optional faster json parser, falling back to the standard library
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Optional streaming json parser used to avoid decoding every release
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Identifies this script to the mod portal
+_USER_AGENT = 'factorio-mod-updater/0.1.0'
+
+# Maximum number of concurrent requests issued against the mod portal
+_MAX_WORKERS = 16
+
+# Maximum number of mods downloaded concurrently during an update
+_UPDATE_WORKERS = 4
+
+# Location of the on-disk cache of the latest release of each mod
+_CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME',
+                   os.path.join(os.path.expanduser('~'), '.cache')),
+    'factorio-mod-updater', 'releases.json')
+
+# Seconds a cached metadata entry is used without contacting the mod portal
+_CACHE_TTL = 600
+
+# Release fields retained from the mod portal response; file_size is optional
+_REQUIRED_RELEASE_FIELDS = ('version', 'file_name', 'download_url', 'sha1')
+_RELEASE_FIELDS = _REQUIRED_RELEASE_FIELDS + ('file_size',)
+
+# Matches installed mod archives, capturing the mod name and version
+_MOD_FILE_RE = re.compile(r'^(.+)_(.+)\.zip$')
+
+# Matches the version banner printed by 'factorio --version'
+_VERSION_RE = re.compile(r'Version: (\d+)\.(\d+)\.(\d+)')
+
+
+def _vkey(version: str) -> tuple:
+    """
+    Converts a dotted version string into a tuple suitable for ordering.
+
+    Keyword Arguments:
+    version -- version string such as '0.17.3'
+    """
+    return tuple(int(part) for part in version.split('.'))
+
+
+def _valid_cache_entry(entry) -> bool:
+    """
+    Checks that a release cache entry has the shape written by the updater.
+
+    Keyword Arguments:
+    entry -- cache entry loaded from disk
+    """
+    if not isinstance(entry, dict) \
+            or not isinstance(entry.get('ts'), (int, float)) \
+            or not isinstance(entry.get('etag'), (str, type(None))) \
+            or 'data' not in entry:
+        return False
+
+    release = entry['data']
+    return release is None or (
+        isinstance(release, dict)
+        and all(key in release for key in _REQUIRED_RELEASE_FIELDS))
 
 
 def _validate_hash(checksum: str, target: str,
-                   bsize: int=65536) -> bool:
+                   bsize: int=1048576) -> bool:
     """
     Checks to see if the file specified by target matches the provided sha1
-    checksum.
+    checksum. hashlib.file_digest is used where available (python 3.11+),
+    otherwise the file is memory mapped and hashed in a single update, falling
+    back to reading it in bsize blocks where it cannot be mapped.
 
     Keyword Arguments:
     checksum -- sha1 digest to be matched
     target   -- path to the file which must be validated
     """
-    hasher = hashlib.sha1()
-
     with open(target, 'rb') as target_fp:
-        block = target_fp.read(bsize)
-        while len(block) > 0:
-            hasher.update(block)
+        if hasattr(hashlib, 'file_digest'):
+            hasher = hashlib.file_digest(target_fp, 'sha1')
+            return hasher.hexdigest() == checksum
+
+        hasher = hashlib.sha1()
+        try:
+            with mmap.mmap(target_fp.fileno(), 0,
+                           access=mmap.ACCESS_READ) as target_mm:
+                hasher.update(target_mm)
+        except (ValueError, OSError):
+            # Empty files and some filesystems cannot be mapped
             block = target_fp.read(bsize)
+            while len(block) > 0:
+                hasher.update(block)
+                block = target_fp.read(bsize)
 
     return hasher.hexdigest() == checksum
 
 
+def _stream_to_file_hashing(resp: requests.Response, target: str,
+                            expected_sha1: str, bsize: int=1048576) -> bool:
+    """
+    Streams the body of resp into target in bsize chunks while computing its
+    sha1 digest, avoiding a second pass over the written file. The download is
+    written to a temporary file next to target and only moved into place when
+    the digest matches; otherwise it and any stale target are removed.
+
+    Keyword Arguments:
+    resp          -- streamed response containing the file contents
+    target        -- path to the file which will be written
+    expected_sha1 -- sha1 digest to be matched
+    """
+    hasher = hashlib.sha1()
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target),
+                                    prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb', buffering=bsize) as target_fp:
+            for chunk in resp.iter_content(bsize):
+                target_fp.write(chunk)
+                hasher.update(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    if hasher.hexdigest() != expected_sha1:
+        os.remove(tmp_path)
+        if os.path.exists(target):
+            os.remove(target)
+        return False
+
+    os.replace(tmp_path, target)
+    return True
+
+
 class ModUpdater():
     """
     Internal class managing the current version and state of the mods on this
@@ -67,6 +189,16 @@ class ModUpdater():
         self.mod_server_url = 'https://mods.factorio.com'
         self.mod_path = mod_path
 
+        # Shared session so connections to the mod portal are reused
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = _USER_AGENT
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        # Serializes console output from concurrent updates
+        self._print_lock = threading.Lock()
+
         # Get the credentials to download mods
         if settings_path is not None:
             self._parse_settings(settings_path)
@@ -118,12 +250,11 @@ class ModUpdater():
             sys.exit(1)
 
         try:
-            output = subprocess.check_output(
+            result = subprocess.run(
                 [fact_path, '--version'],
-                universal_newlines=True)
-            ver_re = re.compile(r'Version: (\d+)[.](\d+)[.](\d+) .*\n',
-                                re.RegexFlag.M)
-            match = ver_re.match(output)
+                capture_output=True, text=True, check=True)
+            output = result.stdout
+            match = _VERSION_RE.search(output)
             if match:
                 version = {}
                 version['major'] = match.group(1)
@@ -154,8 +285,8 @@ class ModUpdater():
     def _parse_settings(self, settings_path: str):
         """Process the specified server-settings.json file."""
         try:
-            with open(settings_path, 'r') as settings_fp:
-                self.settings = json.load(settings_fp)
+            with open(settings_path, 'rb') as settings_fp:
+                self.settings = _json_loads(settings_fp.read())
         except IOError as error:
             errmsg = (
                 'error: failed to open file \'{fname}\': '
@@ -174,38 +305,141 @@ class ModUpdater():
         Pull the latest metadata for each mod from the factorio server
         See https://wiki.factorio.com/Mod_portal_API for details
         """
-        print("Retrieving metadata", end='')
-        for mod, data in self.mods.items():
-            mod_url = self.mod_server_url + '/api/mods/' + mod + '/full'
-            with requests.get(mod_url) as req:
-                if not req.status_code == 200:
+        cache = self._load_metadata_cache()
+        release_cache = cache.get(self.fact_version['release'])
+        if not isinstance(release_cache, dict):
+            release_cache = cache[self.fact_version['release']] = {}
+
+        mods = list(self.mods)
+        progress = '\rRetrieving metadata {count}/{total}'
+        last_flush = time.monotonic()
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+            results = zip(mods, executor.map(self._fetch_metadata, mods,
+                                             itertools.repeat(release_cache)))
+            for count, (mod, entry) in enumerate(results, 1):
+                # Only refresh the progress line once per second
+                now = time.monotonic()
+                if now - last_flush >= 1:
+                    sys.stdout.write(progress.format(count=count,
+                                                     total=len(mods)))
+                    sys.stdout.flush()
+                    last_flush = now
+
+                if entry is None:
+                    # Overwrite the progress line with the warning
+                    warnmsg = (
+                        "Warning: Unable to retrieve metadata for"
+                        " {mod}, skipped!".format(mod=mod))
+                    sys.stdout.write('\r' + warnmsg + '\n')
                     continue
-                data['metadata'] = req.json()
+                release_cache[mod] = entry
+                if entry['data'] is not None:
+                    self.mods[mod]['latest'] = entry['data']
+        sys.stdout.write(progress.format(count=len(mods), total=len(mods))
+                         + '...complete!\n')
 
-            # Find the latest release for this version of factorio
-            matching_releases = []
-            for rel in data['metadata']['releases']:
-                rel_ver = rel['info_json']['factorio_version']
-                if rel_ver == self.fact_version['release']:
-                    matching_releases.append(rel)
+        self._save_metadata_cache(cache)
 
-            data['latest'] = matching_releases[-1]
-            print('.', end='', flush=True)
-        print('complete!')
+    def _fetch_metadata(self, mod: str, release_cache: dict) -> dict:
+        """
+        Retrieves the latest release of a single mod, preferring a fresh cache
+        entry and revalidating stale ones with their ETag. Returns the cache
+        entry for the mod or None if the metadata could not be retrieved.
 
-        for mod, data in self.mods.items():
-            if 'metadata' not in data:
-                warnmsg = (
-                    "Warning: Unable to retrieve metadata for"
-                    " {mod}, skipped!".format(mod=mod))
-                print(warnmsg)
+        Keyword Arguments:
+        mod           -- name of the target to retrieve
+        release_cache -- cache entries for the local factorio release
+        """
+        entry = release_cache.get(mod)
+        if not _valid_cache_entry(entry):
+            entry = None
+        now = time.time()
+        if entry is not None and now - entry['ts'] < _CACHE_TTL:
+            return entry
+
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+
+        mod_url = self.mod_server_url + '/api/mods/' + mod + '/full'
+        with self._session.get(mod_url, headers=headers, stream=True) as req:
+            if req.status_code == 304 and entry is not None:
+                return {'ts': now, 'etag': entry['etag'],
+                        'data': entry['data']}
+            if not req.status_code == 200:
+                return None
+
+            if ijson is not None:
+                req.raw.decode_content = True
+                releases = ijson.items(req.raw, 'releases.item',
+                                       use_float=True)
+            else:
+                releases = _json_loads(req.content)['releases']
+            return {'ts': now, 'etag': req.headers.get('ETag'),
+                    'data': self._find_latest(releases)}
+
+    def _find_latest(self, releases) -> dict:
+        """
+        Returns the newest release compatible with the local factorio version,
+        reduced to the fields used by the updater, or None if there isn't one.
+
+        Keyword Arguments:
+        releases -- iterable of release entries from the mod portal
+        """
+        best = best_key = None
+        for rel in releases:
+            if rel['info_json']['factorio_version'] == \
+                    self.fact_version['release']:
+                rel_key = _vkey(rel['version'])
+                if best_key is None or rel_key > best_key:
+                    best, best_key = rel, rel_key
+
+        if best is None:
+            return None
+        return {key: best[key] for key in _RELEASE_FIELDS if key in best}
+
+    @staticmethod
+    def _load_metadata_cache() -> dict:
+        """Loads the on-disk release cache, starting empty if unusable."""
+        try:
+            with open(_CACHE_PATH, 'rb') as cache_fp:
+                cache = _json_loads(cache_fp.read())
+        except (IOError, ValueError):
+            return {}
+
+        return cache if isinstance(cache, dict) else {}
+
+    @staticmethod
+    def _save_metadata_cache(cache: dict):
+        """
+        Atomically writes the release cache back to disk.
+
+        Keyword Arguments:
+        cache -- release cache to be written
+        """
+        cache_dir = os.path.dirname(_CACHE_PATH)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as cache_fp:
+                    json.dump(cache, cache_fp)
+                os.replace(tmp_path, _CACHE_PATH)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except OSError as error:
+            warnmsg = (
+                'Warning: failed to write metadata cache \'{fname}\': '
+                '{errstr}').format(fname=_CACHE_PATH, errstr=error.strerror)
+            print(warnmsg, file=sys.stderr)
 
     def _parse_mod_list(self):
         """Process the mod-list.json within mod_path."""
         mod_list_path = os.path.join(self.mod_path, 'mod-list.json')
         try:
-            settings_fp = open(mod_list_path, 'r')
-            mod_json = json.load(settings_fp)
+            with open(mod_list_path, 'rb') as mod_list_fp:
+                mod_json = _json_loads(mod_list_fp.read())
             self.mods = {}
             if 'mods' in mod_json:
                 for mod in mod_json['mods']:
@@ -235,15 +469,19 @@ class ModUpdater():
             sys.exit(1)
 
         # Collect the installed state & versions
-        self.mod_files = \
-            glob.glob('{mod_path}/*.zip'.format(mod_path=self.mod_path))
+        with os.scandir(self.mod_path) as mod_dir:
+            mod_basenames = [
+                (entry.name, entry.path) for entry in mod_dir
+                if entry.is_file(follow_symlinks=False)
+                and entry.name.endswith('.zip')]
+        self._mod_releases = {}
         installed_mods = {}
-        mod_pattern = re.compile('^(.*)_(.*)[.]zip$')
-        for entry in self.mod_files:
-            basename = os.path.basename(entry)
-            match = mod_pattern.fullmatch(basename)
+        for basename, path in mod_basenames:
+            match = _MOD_FILE_RE.fullmatch(basename)
             if match:
                 installed_mods[match.group(1)] = match.group(2)
+                self._mod_releases.setdefault(match.group(1), []).append(
+                    (basename, path))
 
         for mod, data in self.mods.items():
             if mod in installed_mods:
@@ -255,22 +493,25 @@ class ModUpdater():
     def list(self):
         """Lists the mods installed on this server."""
         # Find the longest mod name
-        max_len = 0
-        for mod in self.mods:
-            mod_len = len(mod)
-            max_len = mod_len if mod_len > max_len else max_len
+        max_len = max((len(mod) for mod in self.mods),
+                      default=len('mod_name'))
 
-        print('{:<{width}}\tenabled\tinstalled\tcurrent_v\tlatest_v'.format(
+        rows = ['{:<{width}}\tenabled\tinstalled\tcurrent_v\tlatest_v'.format(
             'mod_name',
-            width=max_len))
+            width=max_len)]
         for mod, data in self.mods.items():
-            print('{:<{width}}\t{enbld}\t{inst}\t\t{cver}\t\t{lver}'.format(
-                mod,
-                enbld=str(data['enabled']),
-                inst=str(data['installed']),
-                cver=data['version'] if data['installed'] else 'N/A',
-                lver=data['latest']['version'] if 'latest' in data else 'N/A',
-                width=max_len))
+            rows.append(
+                '{:<{width}}\t{enbld}\t{inst}\t\t{cver}\t\t{lver}'.format(
+                    mod,
+                    enbld=str(data['enabled']),
+                    inst=str(data['installed']),
+                    cver=data['version'] if data['installed'] else 'N/A',
+                    lver=(data['latest']['version'] if 'latest' in data
+                          else 'N/A'),
+                    width=max_len))
+
+        # Emit the table with a single write
+        sys.stdout.write('\n'.join(rows) + '\n')
 
     def override_credentials(self, username: str, token: str):
         """Replaces the values provided in server-settings.json"""
@@ -279,24 +520,51 @@ class ModUpdater():
         if token is not None:
             self.token = token
 
-    def update(self):
+    def update(self, strict_verify: bool=False):
         """
         Updates all mods currently installed on this server to the latest
         release
+
+        Keyword Arguments:
+        strict_verify -- hash installed releases even when their size matches
         """
-        for mod, data in self.mods.items():
-            if 'latest' not in data:
-                warnmsg = (
-                    "{mod}: Missing metadata, skipping update!".format(
-                        mod=mod))
-                print(warnmsg)
-            else:
-                self._prune_old_releases(mod)
-                self._download_latest_release(mod)
+        with ThreadPoolExecutor(max_workers=_UPDATE_WORKERS) as executor:
+            futures = [executor.submit(self._update_one, mod, strict_verify)
+                       for mod in self.mods]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Don't start queued updates once one of them failed
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    def _update_one(self, mod: str, strict_verify: bool):
+        """
+        Updates a single mod to its latest release.
+
+        Keyword Arguments:
+        mod           -- name of the target to update
+        strict_verify -- hash installed releases even when their size matches
+        """
+        if 'latest' not in self.mods[mod]:
+            warnmsg = (
+                "{mod}: Missing metadata, skipping update!".format(
+                    mod=mod))
+            self._print(warnmsg)
+        else:
+            kept_latest = self._prune_old_releases(mod)
+            self._download_latest_release(mod, kept_latest, strict_verify)
 
-    def _prune_old_releases(self, mod: str):
+    def _print(self, *args, **kwargs):
+        """Prints while holding the output lock to avoid interleaved lines."""
+        with self._print_lock:
+            print(*args, **kwargs)
+
+    def _prune_old_releases(self, mod: str) -> bool:
         """
         Deletes any locally installed versions older than the latest release.
+        Returns whether the latest release was already installed and kept.
 
         Keyword Arguments:
         mod -- name of the target to update
@@ -304,22 +572,16 @@ class ModUpdater():
         data = self.mods[mod]
         latest_version = data['latest']['version']
 
-        # Declare the patterns
-        mod_pattern = re.compile('^{mod}_.*[.]zip$'.format(mod=mod))
-        version_pattern = re.compile('^{mod}_{ver}.zip$'.format(
-            mod=mod, ver=latest_version))
-
-        # Build the parse list
-        basenames = [os.path.basename(x) for x in self.mod_files]
-        inst_rels = [x for x in basenames if mod_pattern.fullmatch(x)]
-        for rel in inst_rels:
-            if version_pattern.fullmatch(rel):
+        latest_name = '{mod}_{ver}.zip'.format(mod=mod, ver=latest_version)
+        kept_latest = False
+        for rel, rel_path in self._mod_releases.get(mod, []):
+            if rel == latest_name:
+                kept_latest = True
                 continue
 
-            print("{mod}: removing '{target}'".format(
+            self._print("{mod}: removing '{target}'".format(
                 mod=mod, target=rel))
 
-            rel_path = os.path.join(self.mod_path, rel)
             try:
                 os.remove(rel_path)
             except OSError as error:
@@ -327,16 +589,21 @@ class ModUpdater():
                     'error: failed to remove \'{fname}\': '
                     '{errstr}').format(fname=rel_path,
                                        errstr=error.strerror)
-                print(errmsg, file=sys.stderr)
+                self._print(errmsg, file=sys.stderr)
                 sys.exit(1)
 
-    def _download_latest_release(self, mod: str):
+        return kept_latest
+
+    def _download_latest_release(self, mod: str, kept_latest: bool,
+                                 strict_verify: bool):
         """
         Retrieves the latest version of the specified mod compatible with the
         factorio release present on this server.
 
         Keyword Arguments:
-        mod -- name of the target to update
+        mod           -- name of the target to update
+        kept_latest   -- whether pruning left the latest release in place
+        strict_verify -- hash installed releases even when their size matches
         """
         data = self.mods[mod]
         latest = data['latest']
@@ -344,47 +611,74 @@ class ModUpdater():
 
         validate = download = False
 
+        # Status is collected and printed once so concurrent updates don't
+        # interleave partial lines
+        status = []
+
         v_cur = data['version'] if 'version' in data else 'N/A'
         v_new = latest['version']
+
+        # A kept release matching the portal's size is trusted unless strict
+        # verification was requested, even if an older copy set v_cur
+        if kept_latest and not strict_verify \
+                and os.path.getsize(target) == latest.get('file_size'):
+            self._print("{mod}: '{version}' is up to date".format(
+                mod=mod, version=v_new))
+            return
+
         if data['installed']:
             if v_new == v_cur:
-                print("{mod}: validating installed '{version}'...".format(
-                    mod=mod, version=v_cur), end='')
+                status.append(
+                    "{mod}: validating installed '{version}'...".format(
+                        mod=mod, version=v_cur))
                 validate = True
             else:
-                print("{mod}: updating from '{v_cur}' to '{v_new}'...".format(
-                    mod=mod, v_new=v_new, v_cur=v_cur), end='')
+                status.append(
+                    "{mod}: updating from '{v_cur}' to '{v_new}'...".format(
+                        mod=mod, v_new=v_new, v_cur=v_cur))
                 download = True
         else:
-            print("{mod}: downloading version '{version}'...".format(
-                mod=mod, version=v_new), end='')
+            status.append("{mod}: downloading version '{version}'...".format(
+                mod=mod, version=v_new))
+            download = True
+
+        # A size mismatch is enough to reject the installed file without
+        # hashing it
+        if validate and 'file_size' in latest \
+                and os.path.getsize(target) != latest['file_size']:
+            status.append('size mismatch, redownloading...')
+            validate = False
             download = True
 
         if validate:
             if _validate_hash(latest['sha1'], target):
-                print('Valid!')
+                status.append('Valid!')
             else:
-                print('Invalid! Downloading...', end='')
+                status.append('Invalid! Downloading...')
                 download = True
 
         if download:
-            creds = {'username': self.username, 'token': self.token}
-            dl_url = self.mod_server_url + latest['download_url']
-            with requests.get(dl_url, params=creds, stream=True) as req:
-                if req.status_code == 200:
-                    with open(target, 'wb') as target_file:
-                        shutil.copyfileobj(req.raw, target_file)
-                        target_file.flush()
-                else:
-                    warnmsg = (
-                        "Unable to retrieve, skipping!".format(
-                            mod=mod))
-                    print(warnmsg)
+            status.append(self._fetch_release(latest, target))
 
-            if _validate_hash(latest['sha1'], target):
-                print('Complete!')
-            else:
-                print('Download did not match checksum!')
+        self._print(''.join(status))
+
+    def _fetch_release(self, latest: dict, target: str) -> str:
+        """
+        Downloads a release from the mod portal into target, returning the
+        status message describing the outcome.
+
+        Keyword Arguments:
+        latest -- release entry to be downloaded
+        target -- path to the file which will be written
+        """
+        creds = {'username': self.username, 'token': self.token}
+        dl_url = self.mod_server_url + latest['download_url']
+        with self._session.get(dl_url, params=creds, stream=True) as req:
+            if not req.status_code == 200:
+                return 'Unable to retrieve, skipping!'
+            if _stream_to_file_hashing(req, target, latest['sha1']):
+                return 'Complete!'
+            return 'Download did not match checksum!'
 
 
 if __name__ == "__main__":
@@ -422,6 +716,13 @@ if __name__ == "__main__":
         dest='fact_path',
         required=True,
         help='Absolute path to the factorio binary')
+    # Hash validation of up to date mods
+    PARSER.add_argument(
+        '--strict-verify',
+        dest='strict_verify',
+        action='store_true',
+        help='Validate the checksum of installed mods even when their size'
+             ' matches the latest release')
     # Possible Execution modes
     MODE_GROUP = PARSER.add_mutually_exclusive_group(required=True)
     MODE_GROUP.add_argument(
@@ -447,4 +748,4 @@ if __name__ == "__main__":
     if ARGS.mode == ModUpdater.Mode.LIST:
         UPDATER.list()
     elif ARGS.mode == ModUpdater.Mode.UPDATE:
-        UPDATER.update()
+        UPDATER.update(strict_verify=ARGS.strict_verify)